@@ -1,9 +1,16 @@
 import time
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import re
 import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from itertools import islice
+from typing import Dict, Iterator, List, Optional
 from tqdm import tqdm
 from dotenv import load_dotenv
 
@@ -11,7 +18,6 @@ from dotenv import load_dotenv
 import pandas as pd
 import io
 import base64
-import jinja2
 
 # Configuração de logging
 logging.basicConfig(
@@ -33,15 +39,31 @@ API_KEY = os.getenv("FRESHSERVICE_API_KEY")
 DOMAIN = os.getenv("FRESHSERVICE_DOMAIN")
 BASE_URL = f"https://{DOMAIN}/api/v2"
 AUTH = (API_KEY, "X")
+# Threads usadas nas buscas paralelas (associações e detalhes de assets)
+MAX_WORKERS = max(1, int(os.getenv("MAX_WORKERS", 16)))
+
+# Sessão HTTP compartilhada (keep-alive + retry automático em falhas transitórias)
+SESSION = requests.Session()
+SESSION.auth = AUTH
+SESSION.headers.update({"Accept": "application/json"})
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=MAX_WORKERS,  # uma conexão reaproveitável por thread
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504], raise_on_status=False)
+))
 
 # Configurações de alerta (garantindo 365 dias limite de busca)
 DAYS_WARN = int(os.getenv("DAYS_TO_WARN", 365))
 MAKE_URL = os.getenv("MAKE_WEBHOOK_URL")
 EMAIL_TO = os.getenv("EMAIL_TO")
 MAX_ASSETS = int(os.getenv("MAX_ASSETS", 0)) or None
+# Abaixo dessa quantidade de chamadas restantes no minuto, segura o ritmo
+RATE_LIMIT_FLOOR = 20
+# Espera máxima por throttle, em segundos
+RATE_LIMIT_MAX_WAIT = 60
 
 # Assets excluídos
-EXCLUDED_ASSETS = {
+EXCLUDED_ASSETS: frozenset[str] = frozenset({
     "ASSET-96", "ASSET-97", "ASSET-952", "ASSET-953", "ASSET-954", 
     "ASSET-955", "ASSET-956", "ASSET-957", "ASSET-958", "ASSET-959", 
     "ASSET-960", "ASSET-961", "ASSET-962", "ASSET-963", "ASSET-964", 
@@ -59,116 +81,166 @@ EXCLUDED_ASSETS = {
     "ASSET-587", "ASSET-586", "ASSET-585", "ASSET-584", "ASSET-583",
     "ASSET-582", "ASSET-581", "ASSET-580", "ASSET-579", "ASSET-578",
     "ASSET-577", "ASSET-576", "ASSET-575", "ASSET-574", 
-}
+})
+
+# Palavras-chave dos type_fields, em ordem de prioridade
+SERIAL_KWS = ("serial", "service_tag", "srie", "nmero", "imei", "asset_tag")
+EXPIRY_KWS = ("warranty_expiry", "expiry_date", "final_de_suporte", "support_end", "validade", "vencimento")
+FIELD_RE = re.compile("|".join(map(re.escape, SERIAL_KWS + EXPIRY_KWS)))
 
 # ==========================================
 # FUNÇÕES AUXILIARES
 # ==========================================
 
-def get_paged_results(endpoint: str, params: Optional[Dict] = None, desc: str = "Baixando") -> List[Dict]:
+def progress(iterable, **kwargs):
+    # Sem TTY (cron/GitHub Actions) a barra é desligada; no terminal redesenha no máximo 1x por segundo
+    return tqdm(iterable, disable=None, mininterval=1.0, **kwargs)
+
+def throttle(resp: requests.Response):
+    # Só espera quando o próprio Freshservice avisa que a cota está no fim
+    remaining = resp.headers.get("X-Ratelimit-Remaining")
+    if remaining is not None and remaining.isdigit() and int(remaining) < RATE_LIMIT_FLOOR:
+        reset = resp.headers.get("X-Ratelimit-Reset", "1")
+        wait = float(reset) if reset.replace(".", "", 1).isdigit() else 1.0
+        # Valores na casa do epoch são timestamp absoluto, não segundos restantes
+        if wait > 1e9: wait = max(wait - time.time(), 0.0)
+        wait = min(wait, RATE_LIMIT_MAX_WAIT)
+        logger.info(f"Cota da API baixa ({remaining} restantes). Aguardando {wait}s...")
+        time.sleep(wait)
+
+def iter_paged_results(endpoint: str, params: Optional[Dict] = None, desc: str = "Baixando") -> Iterator[Dict]:
+    # Gera os registros conforme as páginas chegam; quem consome decide quando parar
     if params is None: params = {}
-    page, results = 1, []
+    page = 1
     params["per_page"] = 100
     while True:
         params["page"] = page
         try:
-            resp = requests.get(endpoint, auth=AUTH, params=params, timeout=20)
+            resp = SESSION.get(endpoint, params=params, timeout=20)
             if resp.status_code == 429:
                 retry = int(resp.headers.get("Retry-After", 60))
                 logger.warning(f"Rate Limit. Aguardando {retry}s...")
                 time.sleep(retry)
                 continue
             resp.raise_for_status()
+            throttle(resp)
             data = resp.json()
             key = next((k for k in data.keys() if isinstance(data[k], list)), None)
             if not key or not data[key]: break
             batch = data[key]
-            results.extend(batch)
-            if len(batch) < 100: break
-            page += 1
-            time.sleep(0.1)
         except Exception as e:
             logger.error(f"Erro na página {page}: {e}")
             break
-    return results
+        yield from batch
+        if len(batch) < 100: break
+        page += 1
 
 def get_asset_details(display_id: str) -> Dict:
-    try:
-        resp = requests.get(f"{BASE_URL}/assets/{display_id}", auth=AUTH, params={"include": "type_fields"}, timeout=15)
-        return resp.json().get("asset", {}) if resp.status_code == 200 else {}
-    except: return {}
+    while True:
+        try:
+            resp = SESSION.get(f"{BASE_URL}/assets/{display_id}", params={"include": "type_fields"}, timeout=15)
+            if resp.status_code == 429:
+                retry = int(resp.headers.get("Retry-After", 60))
+                logger.warning(f"Rate Limit no asset {display_id}. Aguardando {retry}s...")
+                time.sleep(retry)
+                continue
+            throttle(resp)
+            return resp.json().get("asset", {}) if resp.status_code == 200 else {}
+        except: return {}
+
+def fetch_associations(contract: Dict) -> tuple:
+    c_id, name = contract.get("id"), contract.get("name")
+    assoc = list(iter_paged_results(f"{BASE_URL}/contracts/{c_id}/associated-assets", desc=f"Assoc {name[:15]}"))
+    return c_id, name, contract.get("end_date"), assoc
+
+def map_contract_assets(contracts: List[Dict]) -> Dict:
+    # Associações buscadas em paralelo; o mapa é montado só na thread principal
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        associations = list(progress(ex.map(fetch_associations, contracts), total=len(contracts), desc="Associações"))
+
+    asset_contract_map = {}
+    for c_id, name, end, assoc in associations:
+        for a in assoc:
+            asset_contract_map[a.get("id")] = {"name": name, "end": end}
+    return asset_contract_map
 
 def extract_fields_smart(type_fields: Dict) -> tuple:
-    serial, expiry = None, None
-    normalized = {k.lower(): v for k, v in type_fields.items() if v and str(v).lower() not in ['none', 'n/a', '']}
-    
-    for kw in ["serial", "service_tag", "srie", "nmero", "imei", "asset_tag"]:
-        found = next((k for k in normalized if kw in k), None)
-        if found: 
-            serial = normalized[found]
-            break
-            
-    for kw in ["warranty_expiry", "expiry_date", "final_de_suporte", "support_end", "validade", "vencimento"]:
-        found = next((k for k in normalized if kw in k), None)
-        if found:
-            val = str(normalized[found])
-            if len(val) > 8: 
-                expiry = val
-                break
+    # Uma única passada pelos campos; a regex descarta de cara os que não interessam.
+    # Guarda o primeiro campo de cada palavra-chave para manter a ordem de prioridade.
+    found = {}
+    for k, v in type_fields.items():
+        lk = k.lower()
+        if not FIELD_RE.search(lk): continue
+        if not v or str(v).lower() in ['none', 'n/a', '']: continue
+        for kw in SERIAL_KWS + EXPIRY_KWS:
+            if kw in lk: found.setdefault(kw, v)
+
+    serial = next((found[kw] for kw in SERIAL_KWS if kw in found), None)
+    expiry = next((str(found[kw]) for kw in EXPIRY_KWS if kw in found and len(str(found[kw])) > 8), None)
     return serial, expiry
 
-def parse_date(date_string: str) -> Optional[datetime]:
-    if not date_string: return None
-    try: return datetime.strptime(str(date_string)[:10], "%Y-%m-%d")
-    except: return None
+def filter_deadlines(df: pd.DataFrame, date_col: str, today: datetime, warning_limit: datetime) -> pd.DataFrame:
+    # Filtro vetorizado: pega o passado (vencidos) e o futuro até o limite; datas inválidas viram NaT e saem
+    dt = pd.to_datetime(df[date_col].astype(str).str[:10], format="%Y-%m-%d", errors="coerce")
+    df = df[dt.le(warning_limit)].copy()
+    df["dt"] = dt[df.index]
+    df["days"] = (df["dt"] - today).dt.days
+    return df
 
-# ==========================================
-# A MÁGICA ACONTECE AQUI: Estilos prontos para o Make
-# ==========================================
-# ==========================================
-# ESTILOS E TEXTOS LIMPOS (Sem HTML)
-# ==========================================
 # ==========================================
 # ESTILOS COM EMOJIS NATIVOS PARA EXCEL
 # ==========================================
+# O Excel lê esses emojis perfeitamente como texto
+STYLES = {
+    "vencido": "⚫ Vencido",
+    "critical": "🔴 Crítico",
+    "warning": "🟡 Atenção",
+    "info": "🔵 Info",
+}
+
+def get_level(days: int) -> str:
+    if days < 0: return "vencido"
+    if days <= 90: return "critical"
+    if days <= 120: return "warning"
+    return "info"
+
 def get_style(days: int) -> str:
-    # O Excel lê esses emojis perfeitamente como texto
-    if days < 0: return "⚫ Vencido"
-    if days <= 90: return "🔴 Crítico"
-    if days <= 120: return "🟡 Atenção"
-    return "🔵 Info"
+    return STYLES[get_level(days)]
 
 def clean(val):
     if val is None: return "N/A"
     return str(val).strip().replace('\n', ' ').replace('\r', '')
 
 # ==========================================
-# FUNÇÃO DE ENVIO ATUALIZADA (SEM JINJA2)
+# ENVIO PARA O MAKE
 # ==========================================
+def _format_asset(a: Dict) -> Dict:
+    days, contrato = a["Dias"], a["Contrato"]
+    return {
+        "Status": get_style(days),
+        "Asset": clean(a["Asset"]),
+        "Tag": clean(a["Tag"]),
+        "Serial": clean(a["Serial"]),
+        "Contrato": clean(contrato) if contrato else "Sem contrato",
+        "Vencimento": a["Vencimento Real"],
+        "Dias Restantes": days
+    }
+
+def _format_contract(c: Dict) -> Dict:
+    days = c["days_remaining"]
+    return {
+        "Status": get_style(days),
+        "Contrato": clean(c["contract_name"]),
+        "ID": c["contract_id"],
+        "Vencimento": c["end_date"],
+        "Dias Restantes": days
+    }
+
 def send_to_make(asset_alerts: List[Dict], contract_alerts: List[Dict]) -> bool:
     if not MAKE_URL: return False
-    
-    clean_assets = []
-    for a in asset_alerts:
-        clean_assets.append({
-            "Status": get_style(a["Dias"]), 
-            "Asset": clean(a["Asset"]),
-            "Tag": clean(a["Tag"]), 
-            "Serial": clean(a["Serial"]),
-            "Contrato": clean(a["Contrato"]) if a["Contrato"] else "Sem contrato",
-            "Vencimento": a["Vencimento Real"], 
-            "Dias Restantes": a["Dias"]
-        })
 
-    clean_contracts = []
-    for c in contract_alerts:
-        clean_contracts.append({
-            "Status": get_style(c["days_remaining"]), 
-            "Contrato": clean(c["contract_name"]), 
-            "ID": c["contract_id"], 
-            "Vencimento": c["end_date"], 
-            "Dias Restantes": c["days_remaining"]
-        })
+    clean_assets = list(map(_format_asset, asset_alerts))
+    clean_contracts = list(map(_format_contract, contract_alerts))
 
     all_alerts = clean_assets + clean_contracts
 
@@ -187,23 +259,26 @@ def send_to_make(asset_alerts: List[Dict], contract_alerts: List[Dict]) -> bool:
     excel_base64 = base64.b64encode(output.getvalue()).decode('utf-8')
     filename_date = datetime.now().strftime("%d_%m_%Y")
 
+    # Contagem por status numa única passada (o Status já vem de get_style)
+    counts = Counter(x["Status"] for x in all_alerts)
     payload = {
         "summary": {
             "total_count": len(all_alerts),
-            "vencido_count": len([x for x in all_alerts if x.get("Dias Restantes", 0) < 0]),
-            "critical_count": len([x for x in all_alerts if 0 <= x.get("Dias Restantes", 0) <= 90]),
-            "warning_count": len([x for x in all_alerts if 91 <= x.get("Dias Restantes", 0) <= 120]),
-            "info_count": len([x for x in all_alerts if 121 <= x.get("Dias Restantes", 0) <= 365])
+            "vencido_count": counts[STYLES["vencido"]],
+            "critical_count": counts[STYLES["critical"]],
+            "warning_count": counts[STYLES["warning"]],
+            "info_count": counts[STYLES["info"]]
         },
         "recipient_email": EMAIL_TO,
-        "generated_at": datetime.now().isoformat(),
+        "generated_at": datetime.now(),
         "file_name": f"Relatorio_Vencimentos_{filename_date}.xlsx",
         "file_data": excel_base64
     }
 
     try:
         logger.info(f"Enviando Excel para o Make: {payload['summary']['total_count']} alertas no total.")
-        r = requests.post(MAKE_URL, json=payload, timeout=60)
+        # orjson serializa o datetime nativamente e é bem mais rápido que o json padrão
+        r = requests.post(MAKE_URL, data=orjson.dumps(payload), headers={"Content-Type": "application/json"}, timeout=60)
         r.raise_for_status()
         logger.info(f"✅ Sucesso! Status: {r.status_code}")
         return True
@@ -220,56 +295,51 @@ def main():
     today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
     warning_limit = today + timedelta(days=DAYS_WARN)
 
-    assets_raw = get_paged_results(f"{BASE_URL}/assets", desc="Assets")
-    contracts_raw = get_paged_results(f"{BASE_URL}/contracts", desc="Contratos")
+    # type_fields já vêm na listagem, evitando um GET por asset
+    # Com MAX_ASSETS a paginação de assets para assim que o limite é atingido
+    assets_raw = list(islice(iter_paged_results(f"{BASE_URL}/assets", params={"include": "type_fields"}, desc="Assets"), MAX_ASSETS))
+    # Excluídos saem logo na ingestão e não são processados em nenhuma etapa
+    assets_raw = [a for a in assets_raw if a.get("asset_tag") not in EXCLUDED_ASSETS]
+    contracts_raw = list(iter_paged_results(f"{BASE_URL}/contracts", desc="Contratos"))
 
-    contract_alerts = []
-    asset_contract_map = {}
-    
-    for c in tqdm(contracts_raw, desc="Analisando Contratos"):
-        c_id, name = c.get("id"), c.get("name")
-        end_dt = parse_date(c.get("end_date"))
-        
-        # Filtro: Pega o passado (vencidos) e o futuro até 365 dias
-        if end_dt and end_dt <= warning_limit:
-            days = (end_dt - today).days
-            contract_alerts.append({
-                "contract_name": name,
-                "contract_id": c_id,
-                "vendor": c.get("vendor_name", "N/A"),
-                "end_date": end_dt.strftime("%d/%m/%Y"),
-                "days_remaining": days
-            })
-        
-        assoc = get_paged_results(f"{BASE_URL}/contracts/{c_id}/associated-assets", desc=f"Assoc {name[:15]}")
-        for a in assoc:
-            asset_contract_map[a.get("id")] = {"name": name, "end": c.get("end_date")}
+    cdf = pd.DataFrame(contracts_raw, columns=["id", "name", "vendor_name", "end_date"], dtype=object)
+    cdf = filter_deadlines(cdf, "end_date", today, warning_limit)
+    contract_alerts = pd.DataFrame({
+        "contract_name": cdf["name"],
+        "contract_id": cdf["id"],
+        "vendor": cdf["vendor_name"].fillna("N/A"),
+        "end_date": cdf["dt"].dt.strftime("%d/%m/%Y"),
+        "days_remaining": cdf["days"]
+    }).to_dict("records")
+
+    # Todos os contratos entram no mapa: se o asset está em mais de um, vale o último da listagem
+    asset_contract_map = map_contract_assets(contracts_raw)
 
-    asset_alerts = []
-    if MAX_ASSETS: assets_raw = assets_raw[:MAX_ASSETS]
+    # Fallback: só busca o detalhe (em paralelo) dos assets que vieram sem type_fields
+    missing = [i for i, a in enumerate(assets_raw) if "type_fields" not in a]
+    if missing:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+            fetched = ex.map(get_asset_details, (assets_raw[i].get("display_id") for i in missing))
+            for i, det in zip(missing, progress(fetched, total=len(missing), desc="Detalhes de Assets")):
+                assets_raw[i] = det or assets_raw[i]
 
-    for asset in tqdm(assets_raw, desc="Analisando Assets"):
-        if asset.get("asset_tag") in EXCLUDED_ASSETS: continue
-        
-        det = get_asset_details(asset.get("display_id"))
-        serial, expiry = extract_fields_smart(det.get("type_fields", {}))
+    rows = []
+    for det in assets_raw:
+        serial, expiry = extract_fields_smart(det.get("type_fields") or {})
         c_info = asset_contract_map.get(det.get("id"), {})
-        
-        check_date = expiry if expiry else c_info.get("end")
-        dt = parse_date(check_date)
-        
-        # Filtro: Pega o passado (vencidos) e o futuro até 365 dias
-        if dt and dt <= warning_limit:
-            days = (dt - today).days
-            asset_alerts.append({
-                "Asset": det.get("name"),
-                "Tag": det.get("asset_tag"),
-                "Serial": serial,
-                "Contrato": c_info.get("name"),
-                "Vencimento Real": dt.strftime("%d/%m/%Y"),
-                "Dias": days
-            })
-        time.sleep(0.05)
+        rows.append({
+            "Asset": det.get("name"),
+            "Tag": det.get("asset_tag"),
+            "Serial": serial,
+            "Contrato": c_info.get("name"),
+            "check_date": expiry if expiry else c_info.get("end")
+        })
+
+    adf = pd.DataFrame(rows, columns=["Asset", "Tag", "Serial", "Contrato", "check_date"], dtype=object)
+    adf = filter_deadlines(adf, "check_date", today, warning_limit)
+    adf["Vencimento Real"] = adf["dt"].dt.strftime("%d/%m/%Y")
+    adf["Dias"] = adf["days"]
+    asset_alerts = adf[["Asset", "Tag", "Serial", "Contrato", "Vencimento Real", "Dias"]].to_dict("records")
 
     if asset_alerts or contract_alerts:
         send_to_make(asset_alerts, contract_alerts)